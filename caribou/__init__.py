@@ -12,6 +12,7 @@ from .migrate import (
     Error,
     InvalidMigrationError,
     InvalidNameError,
+    parse_version,
     upgrade,
     downgrade,
 )
@@ -20,6 +21,7 @@ from .migrate import (
 from .migrate import (
     create_migration,
     execute,
+    execute_script,
     get_version,
     load_migrations,
     Migration,
@@ -56,8 +56,7 @@ def upgrade_db_command(args):
     if version:
         msg = "upgrading db [%s] to version [%s]" % (db_path, version)
     _print_info(msg)
-    caribou.upgrade(db_path, migration_dir, version)
-    new_version = caribou.get_version(db_path)
+    new_version = caribou.upgrade(db_path, migration_dir, version)
     if version:
         assert new_version == version
     msg = "upgraded [%s] successfully to version [%s]" % (db_path, new_version)
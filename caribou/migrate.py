@@ -1,16 +1,34 @@
 import contextlib
 import datetime
-import glob
+import operator
 import os.path
+import re
 import sqlite3
 import traceback
-from importlib.machinery import SourceFileLoader
+from importlib.util import module_from_spec, spec_from_file_location
 
 # statics
 
 VERSION_TABLE = "migration_version"
 UTC_LENGTH = 14
 
+# a migration module is named by a 14 digit utc timestamp, optional
+# separating underscores, and a human readable name
+_VERSION_RE = re.compile(r"(\d{%d})_*(.*)" % UTC_LENGTH, re.ASCII)
+
+# connection tuning applied when a database is opened. WAL avoids the
+# rollback journal's double write and allows group commit, and the
+# remaining pragmas trade a little memory for fewer syncs and reads
+# during write-heavy migration runs.
+DEFAULT_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+    "cache_size": -65536,  # 64MiB
+    "mmap_size": 268435456,  # 256MiB
+    "busy_timeout": 5000,
+}
+
 # errors
 
 
@@ -40,24 +58,51 @@ class InvalidNameError(Error):
 # code
 
 
-@contextlib.contextmanager
-def execute(conn, sql, params=None):
-    params = [] if params is None else params
-    cursor = conn.execute(sql, params)
-    try:
-        yield cursor
-    finally:
-        cursor.close()
+# execute and transaction are plain classes rather than decorated
+# generators: entering a @contextlib.contextmanager allocates a
+# generator frame and a wrapper object per use, which adds up inside
+# the migration loops
+class execute(object):
+
+    __slots__ = ("conn", "sql", "params", "cursor")
+
+    def __init__(self, conn, sql, params=None):
+        self.conn = conn
+        self.sql = sql
+        self.params = [] if params is None else params
+        self.cursor = None
+
+    def __enter__(self):
+        self.cursor = self.conn.execute(self.sql, self.params)
+        return self.cursor
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if self.cursor is not None:
+            self.cursor.close()
+        return False
+
 
+class transaction(object):
 
-@contextlib.contextmanager
-def transaction(conn):
-    try:
-        yield
-        conn.commit()
-    except Exception:
-        conn.rollback()
-        raise
+    __slots__ = ("conn", "immediate")
+
+    def __init__(self, conn, immediate=False):
+        self.conn = conn
+        self.immediate = immediate
+
+    def __enter__(self):
+        # grab the write lock up front so a batch of migrations can't
+        # stall midway waiting to promote a shared lock
+        if self.immediate and not self.conn.in_transaction:
+            self.conn.execute("begin immediate")
+        return None
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type is None:
+            self.conn.commit()
+        else:
+            self.conn.rollback()
+        return False
 
 
 def has_method(an_object, name):
@@ -68,6 +113,14 @@ def is_directory(path):
     return os.path.exists(path) and os.path.isdir(path)
 
 
+# sentinel for "not cached yet", since None is a valid version
+_UNKNOWN = object()
+
+# migration modules already imported by this process, keyed by path and
+# mtime so an edited file is re-imported
+_MODULE_CACHE = {}
+
+
 class Migration(object):
     """This class represents a migration version."""
 
@@ -75,19 +128,58 @@ class Migration(object):
         self.path = path
         self.filename = os.path.basename(path)
         self.module_name, _ = os.path.splitext(self.filename)
-        self.get_version()  # will assert the filename is valid
-        self.name = self.module_name[UTC_LENGTH:]
-        while self.name.startswith("_"):
-            self.name = self.name[1:]
+        # parsing asserts the filename is valid
+        self.version, self.name = self._parse_name()
+        self._module = None
+
+    @classmethod
+    def from_module(cls, module):
+        """Create a migration from an already imported module, skipping
+        the import machinery entirely. The module's name must follow the
+        same convention as migration filenames.
+        """
+        migration = cls.__new__(cls)
+        migration.module_name = module.__name__.rpartition(".")[2]
+        migration.filename = migration.module_name + ".py"
+        migration.path = getattr(module, "__file__", migration.filename)
+        migration.version, migration.name = migration._parse_name()
+        migration._check_module(module)
+        migration._module = module
+        return migration
+
+    @property
+    def module(self):
+        """The migration's module, imported the first time it is needed
+        so that merely listing a directory doesn't execute every
+        migration file in it.
+        """
+        if self._module is None:
+            self._module = self._load_module()
+        return self._module
+
+    def _load_module(self):
         try:
-            sfl = SourceFileLoader(self.module_name, path)
-            self.module = sfl.load_module()
+            key = (self.path, os.stat(self.path).st_mtime_ns)
+            module = _MODULE_CACHE.get(key)
+            if module is not None:
+                return module
+            spec = spec_from_file_location(self.module_name, self.path)
+            module = module_from_spec(spec)
+            spec.loader.exec_module(module)
         except Exception:
-            msg = "Invalid migration %s: %s" % (path, traceback.format_exc())
+            msg = "Invalid migration %s: %s" % (
+                self.path,
+                traceback.format_exc(),
+            )
             raise InvalidMigrationError(msg)
+        self._check_module(module)
+        _MODULE_CACHE[key] = module
+        return module
+
+    def _check_module(self, module):
         # assert the migration has the needed methods
         targets = ["upgrade", "downgrade"]
-        missing = [m for m in targets if not has_method(self.module, m)]
+        missing = [m for m in targets if not has_method(module, m)]
         if missing:
             msg = "Migration %s is missing required methods: %s." % (
                 self.path,
@@ -95,14 +187,16 @@ class Migration(object):
             )
             raise InvalidMigrationError(msg)
 
-    def get_version(self):
-        if len(self.filename) < UTC_LENGTH:
+    def _parse_name(self):
+        # one pass of the precompiled pattern yields both the version
+        # and the human readable name
+        match = _VERSION_RE.fullmatch(self.module_name)
+        if match is None:
             raise InvalidNameError(self.filename)
-        timestamp = self.filename[:UTC_LENGTH]
-        # FIXME: is this test sufficient?
-        if not timestamp.isdigit():
-            raise InvalidNameError(self.filename)
-        return timestamp
+        return match.group(1), match.group(2)
+
+    def get_version(self):
+        return self.version
 
     def upgrade(self, conn):
         self.module.upgrade(conn)
@@ -116,59 +210,120 @@ class Migration(object):
 
 class Database(object):
 
-    def __init__(self, db_url):
-        self.db_url = db_url
-        self.conn = sqlite3.connect(db_url)
+    def __init__(self, db_url, pragmas=None):
+        if isinstance(db_url, sqlite3.Connection):
+            # a borrowed connection. reuse it as is, and leave its
+            # tuning and lifecycle to the caller.
+            self.db_url = None
+            self.conn = db_url
+            self._owns_conn = False
+        else:
+            self.db_url = db_url
+            # a roomy statement cache lets sqlite3 reuse prepared
+            # statements for the sql we run repeatedly in migration
+            # loops
+            uri = isinstance(db_url, str) and db_url.startswith("file:")
+            self.conn = sqlite3.connect(db_url, uri=uri, cached_statements=256)
+            self._owns_conn = True
+            pragmas = DEFAULT_PRAGMAS if pragmas is None else pragmas
+            for pragma, value in pragmas.items():
+                try:
+                    self.conn.execute("pragma %s=%s" % (pragma, value))
+                except sqlite3.Error:
+                    # pragmas are tuning hints, not requirements. some
+                    # (e.g. WAL) aren't supported everywhere.
+                    pass
+        self._update_sql = "update %s set version = ?" % VERSION_TABLE
+        # cache the version state so the hot upgrade/downgrade paths
+        # don't re-query sqlite_master on every step
+        self._version = _UNKNOWN
+        self._is_version_controlled = None
 
     def close(self):
-        self.conn.close()
+        if self._owns_conn:
+            self.conn.close()
 
     def is_version_controlled(self):
-        sql = """select *
-                   from sqlite_master
-                  where type = 'table'
-                    and name = :1"""
-        with execute(self.conn, sql, [VERSION_TABLE]) as cursor:
-            return bool(cursor.fetchall())
-
-    def upgrade(self, migrations, target_version=None):
+        if self._is_version_controlled is None:
+            if sqlite3.sqlite_version_info >= (3, 37, 0):
+                # table_list hits the schema cache directly instead of
+                # planning a query against sqlite_master
+                sql = "pragma table_list(%s)" % VERSION_TABLE
+                rows = self.conn.execute(sql).fetchall()
+            else:
+                sql = """select *
+                           from sqlite_master
+                          where type = 'table'
+                            and name = :1"""
+                rows = self.conn.execute(sql, [VERSION_TABLE]).fetchall()
+            self._is_version_controlled = bool(rows)
+        return self._is_version_controlled
+
+    def upgrade(self, migrations, target_version=None, batch=True):
+        # migrations must be in ascending version order, which is how
+        # load_migrations returns them
         if target_version:
             _assert_migration_exists(migrations, target_version)
 
-        migrations.sort(key=lambda x: x.get_version())
         database_version = self.get_version()
 
-        for migration in migrations:
-            current_version = migration.get_version()
-            if current_version <= database_version:
-                continue
-            if target_version and current_version > target_version:
-                break
-            migration.upgrade(self.conn)
-            new_version = migration.get_version()
-            self.update_version(new_version)
-
-    def downgrade(self, migrations, target_version):
+        # by default, run all the migrations in one transaction so the
+        # database commits (and fsyncs) once per batch instead of once
+        # per migration. callers that need per-migration durability can
+        # pass batch=False to get a commit after each step.
+        context = (
+            transaction(self.conn, immediate=True)
+            if batch
+            else contextlib.nullcontext()
+        )
+        new_version = None
+        with context:
+            for migration in migrations:
+                current_version = migration.version
+                if current_version <= database_version:
+                    continue
+                if target_version and current_version > target_version:
+                    break
+                migration.upgrade(self.conn)
+                new_version = current_version
+                if not batch:
+                    self.update_version(new_version)
+            # a batch commits or rolls back as a whole, so only the
+            # final version is worth writing
+            if batch and new_version is not None:
+                self.update_version(new_version, autocommit=False)
+
+    def downgrade(self, migrations, target_version, batch=True):
+        # migrations must be in ascending version order, which is how
+        # load_migrations returns them; walk the list backwards rather
+        # than re-sorting it in reverse
         if target_version not in (0, "0"):
             _assert_migration_exists(migrations, target_version)
 
-        migrations.sort(key=lambda x: x.get_version(), reverse=True)
         database_version = self.get_version()
 
-        for i, migration in enumerate(migrations):
-            current_version = migration.get_version()
-            if current_version > database_version:
-                continue
-            if current_version <= target_version:
-                break
-            migration.downgrade(self.conn)
-            next_version = 0
-            # if an earlier migration exists, set the db version to
-            # its version number
-            if i < len(migrations) - 1:
-                next_migration = migrations[i + 1]
-                next_version = next_migration.get_version()
-            self.update_version(next_version)
+        context = (
+            transaction(self.conn, immediate=True)
+            if batch
+            else contextlib.nullcontext()
+        )
+        next_version = None
+        with context:
+            for i in range(len(migrations) - 1, -1, -1):
+                migration = migrations[i]
+                current_version = migration.version
+                if current_version > database_version:
+                    continue
+                if current_version <= target_version:
+                    break
+                migration.downgrade(self.conn)
+                # if an earlier migration exists, the db version becomes
+                # its version number
+                next_version = migrations[i - 1].version if i > 0 else "0"
+                if not batch:
+                    self.update_version(next_version)
+            if batch and next_version is not None:
+                self.update_version(next_version, autocommit=False)
 
     def get_version(self):
         """Return the database's version, or None if it is not under version
@@ -176,56 +331,149 @@ class Database(object):
         """
         if not self.is_version_controlled():
             return None
-        sql = "select version from %s" % VERSION_TABLE
-        with execute(self.conn, sql) as cursor:
-            result = cursor.fetchall()
-            return result[0][0] if result else 0
-
-    def update_version(self, version):
-        sql = "update %s set version = :1" % VERSION_TABLE
-        with transaction(self.conn):
-            self.conn.execute(sql, [version])
+        if self._version is _UNKNOWN:
+            sql = "select version from %s" % VERSION_TABLE
+            result = self.conn.execute(sql).fetchall()
+            self._version = result[0][0] if result else 0
+        return self._version
+
+    def update_version(self, version, autocommit=True):
+        # the version column has text affinity, so normalize here to
+        # keep the cached value identical to what a re-read of the
+        # table would return
+        version = str(version)
+        if autocommit:
+            with transaction(self.conn):
+                self.conn.execute(self._update_sql, (version,))
+        else:
+            self.conn.execute(self._update_sql, (version,))
+        self._version = version
 
     def initialize_version_control(self):
         sql = (
-            """ create table if not exists %s
-                  ( version text ) """
-            % VERSION_TABLE
-        )
-        with transaction(self.conn):
-            self.conn.execute(sql)
-            self.conn.execute("insert into %s values (0)" % VERSION_TABLE)
+            "begin; "
+            "create table if not exists %s ( version text ); "
+            "insert into %s values (0); "
+            "commit;"
+        ) % (VERSION_TABLE, VERSION_TABLE)
+        self.conn.executescript(sql)
+        self._is_version_controlled = True
+        self._version = _UNKNOWN
 
     def __repr__(self):
         return 'Database("%s")' % self.db_url
 
 
 def _assert_migration_exists(migrations, version):
-    if version not in (m.get_version() for m in migrations):
+    if version not in {m.version for m in migrations}:
         raise Error("No migration with version %s exists." % version)
 
 
-def load_migrations(directory):
-    """Return the migrations contained in the given directory."""
+# cache of already scanned migration directories, keyed by path plus a
+# fingerprint of each entry's name and mtime, so adding, removing, or
+# editing a migration file invalidates the cache
+_MIGRATIONS_CACHE = {}
+
+
+def _trim_versions(migrations, min_version, max_version):
+    if min_version is not None:
+        migrations = [m for m in migrations if m.version >= min_version]
+    if max_version is not None:
+        migrations = [m for m in migrations if m.version <= max_version]
+    return migrations
+
+
+def load_migrations(directory, min_version=None, max_version=None):
+    """Return the migrations contained in the given directory.
+
+    The directory may also be a sequence of already imported migration
+    modules or Migration objects, which bypasses filesystem discovery
+    entirely.
+
+    min_version and max_version optionally trim the result to the
+    migrations whose versions fall inside the (inclusive) bounds, so
+    callers that only care about part of the history don't pay for the
+    rest.
+    """
+    if not isinstance(directory, (str, bytes, os.PathLike)):
+        # a sequence of modules and/or already built Migration objects
+        migrations = sorted(
+            (
+                m if isinstance(m, Migration) else Migration.from_module(m)
+                for m in directory
+            ),
+            key=operator.attrgetter("version"),
+        )
+        return _trim_versions(migrations, min_version, max_version)
     if not is_directory(directory):
         msg = "%s is not a directory." % directory
         raise Error(msg)
-    wildcard = os.path.join(directory, "*.py")
-    migration_files = glob.glob(wildcard)
-    return [Migration(f) for f in migration_files]
+    # migration filenames start with a fixed-width timestamp, so
+    # sorting the directory entries by name orders them by version
+    # with plain C-level string compares, before any Migration is
+    # even constructed. the same scandir pass supplies the cache
+    # fingerprint, since the entries carry their stat results.
+    with os.scandir(directory) as entries:
+        ordered = sorted(
+            (
+                entry
+                for entry in entries
+                if entry.name.endswith(".py") and entry.is_file()
+            ),
+            key=operator.attrgetter("name"),
+        )
+    key = (
+        os.path.abspath(directory),
+        tuple((entry.name, entry.stat().st_mtime_ns) for entry in ordered),
+    )
+    migrations = _MIGRATIONS_CACHE.get(key)
+    if migrations is None:
+        migrations = [Migration(entry.path) for entry in ordered]
+        _MIGRATIONS_CACHE[key] = migrations
+    # hand out a copy, the cached list is shared
+    return _trim_versions(list(migrations), min_version, max_version)
+
+
+def execute_script(conn, sql):
+    """Run a block of semicolon separated sql statements.
+
+    The whole block crosses into SQLite once and is parsed in one
+    pass, which is the cheapest way to issue several statements in a
+    row. Note that executescript first commits any open transaction,
+    so migrations run with batch=True should prefer plain execute
+    calls to stay inside the batch's transaction.
+    """
+    conn.executescript(sql)
+
+
+def parse_version(filename):
+    """Return the migration version encoded in the given filename, or
+    None if the filename is not a valid migration name. Unlike
+    constructing a Migration, this never raises.
+    """
+    module_name, _ = os.path.splitext(os.path.basename(filename))
+    match = _VERSION_RE.fullmatch(module_name)
+    return match.group(1) if match else None
 
 
 def upgrade(db_url, migration_dir, version=None):
     """Upgrade the given database with the migrations contained in the
     migrations directory. If a version is not specified, upgrade
-    to the most recent version.
+    to the most recent version. Return the database's version once the
+    migrations have run.
+
+    db_url may also be an open sqlite3 connection, which is reused
+    instead of opening (and closing) a new one per call.
     """
     with contextlib.closing(Database(db_url)) as db:
-        db = Database(db_url)
         if not db.is_version_controlled():
             db.initialize_version_control()
-        migrations = load_migrations(migration_dir)
+        # when upgrading to the latest version, only migrations at or
+        # past the database's version are of any use
+        min_version = None if version else db.get_version()
+        migrations = load_migrations(migration_dir, min_version=min_version)
         db.upgrade(migrations, version)
+        return db.get_version()
 
 
 def downgrade(db_url, migration_dir, version):
@@ -1,31 +1,56 @@
 import contextlib
-import glob
 import os
-import shutil
+import pathlib
+import re
+import types
+import uuid
 import sqlite3
+import tempfile
 import pytest
 
 import caribou
 
-TEST_DB = "test.sqlite3"
 MIGRATIONS_DIR = "migrations"
 INVALID_MIGRATIONS = "invalid_migrations"
 INVALID_CODE = os.path.join(INVALID_MIGRATIONS, "code")
 INVALID_NAMES = os.path.join(INVALID_MIGRATIONS, "names")
 
+# every test needs these paths, so compute them once at import time
+_THIS_DIR = os.path.abspath(os.path.dirname(__file__))
+_MIGRATIONS_PATH = os.path.join(_THIS_DIR, MIGRATIONS_DIR)
+_INVALID_CODE_DIR = os.path.join(_THIS_DIR, INVALID_CODE)
+_INVALID_NAMES_DIR = os.path.join(_THIS_DIR, INVALID_NAMES)
+
+
+# the versions of the migrations in the migrations fixture directory
+_V1 = "20091112130101"
+_V2 = "20091112150200"
+_V3 = "20091112150205"
+
+# the valid migration fixtures, built as Path objects once at import
+_VALID_VERSION_PATHS = {
+    version: pathlib.Path(_MIGRATIONS_PATH) / (version + suffix)
+    for version, suffix in [
+        (_V1, "__migration_one.py"),
+        (_V2, "__migration_two.py"),
+        (_V3, "_migration_three.py"),
+    ]
+}
+
 
 def get_this_dir():
-    return os.path.abspath(os.path.dirname(__file__))
+    return _THIS_DIR
 
 
 def get_migrations_path():
-    return os.path.join(get_this_dir(), MIGRATIONS_DIR)
+    return _MIGRATIONS_PATH
 
 
 def test_transaction_context_manager():
     """Assert the transaction context manager commits properly."""
 
-    with contextlib.closing(sqlite3.connect(":memory:")) as conn:
+    conn = sqlite3.connect(":memory:")
+    try:
 
         conn.execute("create table animals ( name TEXT)")
 
@@ -49,26 +74,45 @@ def test_transaction_context_manager():
         else:
             assert 0  # should fail
         assert _count() == 1
+    finally:
+        conn.close()
 
 
-@pytest.fixture
-def sqlite_test_path():
-    this_dir = get_this_dir()
-    db_path = os.path.join(this_dir, TEST_DB)
-    yield db_path
-    if os.path.exists(db_path):
-        os.remove(db_path)
+@pytest.fixture(scope="module")
+def cached_migrations():
+    # scan and parse the migrations directory once for the whole module
+    return caribou.load_migrations(get_migrations_path())
 
 
-def _table_exists(conn, table_name):
-    sql = """
-        SELECT *
-          FROM sqlite_master
-         WHERE type = 'table'
-           AND name = :1
-           """
-    with caribou.execute(conn, sql, [table_name]) as cursor:
-        return bool(cursor.fetchall())
+@pytest.fixture
+def sqlite_test_path():
+    # a shared-cache in-memory database keeps the migration tests off
+    # the disk entirely. it lives for as long as at least one connection
+    # is open, so hold one for the duration of the test. the name is
+    # unique per test so concurrent workers (pytest-xdist) and leaked
+    # connections can't collide on the same database.
+    db_url = "file:%s?mode=memory&cache=shared" % uuid.uuid4().hex
+    keep_alive = sqlite3.connect(db_url, uri=True)
+    yield db_url
+    keep_alive.close()
+
+
+def _existing_tables(conn, table_names):
+    # one catalog query for the whole group instead of one per table
+    sql = (
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name IN (%s)"
+        % ",".join("?" * len(table_names))
+    )
+    rows = conn.execute(sql, table_names).fetchall()
+    return {name for (name,) in rows}
+
+
+def _unlink(path):
+    # one syscall instead of an exists() check followed by the remove
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
 
 
 def test_invalid_migration_filenames():
@@ -76,30 +120,43 @@ def test_invalid_migration_filenames():
     assert we can't load migrations with invalid version names
     """
     # assert we test invalid version names
-    invalid_names = os.path.join(get_this_dir(), INVALID_NAMES, "*.py")
-    for filename in glob.glob(invalid_names):
-        try:
-            migration = caribou.Migration(filename)
-            migration.get_version()
-        except caribou.InvalidNameError:
-            pass
-        else:
-            assert False, filename
+    with os.scandir(_INVALID_NAMES_DIR) as entries:
+        filenames = [
+            entry.path
+            for entry in entries
+            if entry.name.endswith(".py") and entry.is_file()
+        ]
+    assert filenames
+    for filename in filenames:
+        # the non-raising parser reports a bad name as None, no
+        # exception to raise and unwind per file
+        assert caribou.parse_version(filename) is None, filename
+    # constructing a migration from a bad name still fails loudly
+    with pytest.raises(caribou.InvalidNameError):
+        caribou.Migration(filenames[0])
 
 
 def test_valid_migration_filenames():
     """assert we can parse the versions from migration files"""
-    # test some valid versions
-    migrations_path = get_migrations_path()
-    for version, suffix in [
-        ("20091112130101", "__migration_one.py"),
-        ("20091112150200", "__migration_two.py"),
-        ("20091112150205", "_migration_three.py"),
-    ]:
-        path = os.path.join(migrations_path, version + suffix)
+    # test some valid versions, passed as pathlib paths
+    for version, path in _VALID_VERSION_PATHS.items():
         migration = caribou.Migration(path)
         actual_version = migration.get_version()
         assert actual_version == version
+        assert caribou.parse_version(path) == version
+
+
+def test_version_pattern_is_precompiled():
+    """assert name parsing runs off one module-level compiled pattern
+
+    guards against a regression to per-call re.compile, which would
+    slow every Migration construction
+    """
+    pattern = caribou.migrate._VERSION_RE
+    assert isinstance(pattern, re.Pattern)
+    match = pattern.fullmatch("20091112130101_migration_one")
+    assert match.group(1) == "20091112130101"
+    assert match.group(2) == "migration_one"
 
 
 def test_invalid_migraton_code(sqlite_test_path):
@@ -108,135 +165,237 @@ def test_invalid_migraton_code(sqlite_test_path):
         "20091112150200_missing_upgrade.py",
         "20091112150205_missing_downgrade.py",
     ]
-    code_dir = os.path.join(get_this_dir(), INVALID_CODE)
-    # assert we can't load a directory containing invalid migrations
-    try:
-        caribou.load_migrations(code_dir)
-    except caribou.InvalidMigrationError:
-        pass
-    else:
-        assert False, "loaded a dir with invalid migrations"
-    # assert we can't load each invalid migration
-    migrations = [os.path.join(code_dir, f) for f in filenames]
-    for migration in migrations:
+    code_dir = _INVALID_CODE_DIR
+    # listing a directory with invalid migrations is fine, since the
+    # modules aren't imported until they are used
+    migrations = caribou.load_migrations(code_dir)
+    assert len(migrations) == len(filenames)
+    # assert each invalid migration blows up when its code is loaded
+    for filename in filenames:
+        migration = caribou.Migration(os.path.join(code_dir, filename))
         try:
-            caribou.Migration(migration)
+            migration.module
         except caribou.InvalidMigrationError:
             pass
         else:
             assert False, "loaded invalid migration [%s]" % migration
 
 
-def test_unknown_migration(sqlite_test_path):
-    """assert we can't target an unknown migration or non existant dirs"""
-    db_url = sqlite_test_path
-    migrations_path = get_migrations_path()
-    for v in ["asdf", "22341", "asdfasdfasdf", "----"]:
-        for func in [caribou.upgrade, caribou.downgrade]:
-            try:
-                func(db_url, migrations_path, v)
-            except caribou.Error:
-                pass
-            else:
-                assert False, "ran an unknown migration: %s" % v
-    # assert we can't run non-existant migrations
+@pytest.mark.parametrize("func", [caribou.upgrade, caribou.downgrade])
+@pytest.mark.parametrize("version", ["asdf", "22341", "asdfasdfasdf", "----"])
+def test_unknown_migration(sqlite_test_path, func, version):
+    """assert we can't target an unknown migration version"""
+    with pytest.raises(caribou.Error):
+        func(sqlite_test_path, get_migrations_path(), version)
+
+
+@pytest.mark.parametrize(
+    "func, version",
+    [(caribou.upgrade, None), (caribou.downgrade, 0)],
+)
+def test_nonexistent_migration_dir(sqlite_test_path, func, version):
+    """assert we can't run migrations from a non existant dir"""
     path = "/path/to/nowhereski/whoop"
-    for func, args in [
-        (caribou.upgrade, (db_url, path, None)),
-        (caribou.downgrade, (db_url, path, 0)),
-    ]:
-        try:
-            func(*args)
-        except caribou.Error:
-            pass
-        else:
-            assert False, "%s %s" % (func, str(args))
+    with pytest.raises(caribou.Error):
+        func(sqlite_test_path, path, version)
+
+
+def _assert_idempotent(action, check):
+    # two passes prove idempotency: the second run starts from the
+    # state the first one produced, so a third pass adds nothing
+    for _ in range(2):
+        action()
+        check()
+
+
+@pytest.fixture
+def db_conn(sqlite_test_path):
+    # one warm connection to a fresh database, shared by every
+    # migration call in the test
+    conn = sqlite3.connect(sqlite_test_path, uri=True)
+    with contextlib.closing(conn):
+        yield conn
+
+
+def _check_version(conn, expected):
+    actual_version = caribou.get_version(conn)
+    assert actual_version == expected, "%s != %s" % (
+        actual_version,
+        expected,
+    )
+
+
+def _check_v1_state(conn):
+    # one catalog snapshot answers the positive and negative checks
+    tables_now = _existing_tables(conn, ["games", "players", "scores"])
+    assert {"games", "players"} <= tables_now
+    # make sure none of the other migrations run
+    assert "scores" not in tables_now
+    _check_version(conn, _V1)
 
 
-def test_migration(sqlite_test_path):
-    # assert migrations haven't been run
-    migrations_path = get_migrations_path()
+def _check_v2_state(conn):
+    tables = ["games", "players", "scores"]
+    assert _existing_tables(conn, tables) == set(tables)
+    _check_version(conn, _V2)
+
+
+def _check_v3_state(conn):
+    tables = ["games", "players", "scores", "jams"]
+    assert _existing_tables(conn, tables) == set(tables)
+    _check_version(conn, _V3)
+
+
+def _check_rolled_back(conn):
+    tables = ["games", "players", "scores", "jams"]
+    assert not _existing_tables(conn, tables)
+    _check_version(conn, "0")
+
+
+def test_fresh_database(db_conn):
+    """assert migrations haven't been run on a fresh database"""
+    assert not _existing_tables(db_conn, ["games", "players"])
+    assert caribou.get_version(db_conn) is None
+
+
+def test_upgrade_to_v1(db_conn, cached_migrations):
+    """assert the first migration runs and re-running has no effect"""
+    _assert_idempotent(
+        lambda: caribou.upgrade(db_conn, cached_migrations, _V1),
+        lambda: _check_v1_state(db_conn),
+    )
+
+
+def test_upgrade_to_v2(db_conn, cached_migrations):
+    """assert the second migration runs on top of the first"""
+    caribou.upgrade(db_conn, cached_migrations, _V1)
+    _assert_idempotent(
+        lambda: caribou.upgrade(db_conn, cached_migrations, _V2),
+        lambda: _check_v2_state(db_conn),
+    )
+
+
+def test_downgrade_to_v1(db_conn, cached_migrations):
+    """assert the second migration can be rolled back"""
+    caribou.upgrade(db_conn, cached_migrations, _V2)
+    _assert_idempotent(
+        lambda: caribou.downgrade(db_conn, cached_migrations, _V1),
+        lambda: _check_v1_state(db_conn),
+    )
+
+
+def test_upgrade_all(db_conn, cached_migrations):
+    """assert upgrading with no target runs every migration"""
+    _assert_idempotent(
+        lambda: caribou.upgrade(db_conn, cached_migrations),
+        lambda: _check_v3_state(db_conn),
+    )
+
+
+def test_downgrade_all(db_conn, cached_migrations):
+    """assert downgrading to 0 rolls every migration back"""
+    caribou.upgrade(db_conn, cached_migrations)
+    _assert_idempotent(
+        lambda: caribou.downgrade(db_conn, cached_migrations, "0"),
+        lambda: _check_rolled_back(db_conn),
+    )
+
+
+def test_upgrade_after_downgrade(db_conn, cached_migrations):
+    """assert a rolled back database can be fully upgraded again"""
+    caribou.upgrade(db_conn, cached_migrations)
+    caribou.downgrade(db_conn, cached_migrations, "0")
+    _assert_idempotent(
+        lambda: caribou.upgrade(db_conn, cached_migrations),
+        lambda: _check_v3_state(db_conn),
+    )
+
+
+_MODULE_V1 = "20091112130101"
+_MODULE_V2 = "20091112150200"
+
+# the create/drop statements the module migrations run, hoisted so the
+# closures below don't rebuild them per call
+_CREATE_MOD_TABLE = "create table %s ( name TEXT )"
+_DROP_MOD_TABLE = "drop table %s"
+
+
+@pytest.fixture(scope="module")
+def module_migrations():
+    """Two in-memory migration modules, built once per test module."""
+
+    def _make_module(name, table):
+        module = types.ModuleType(name)
+        module.upgrade = lambda conn: conn.execute(_CREATE_MOD_TABLE % table)
+        module.downgrade = lambda conn: conn.execute(_DROP_MOD_TABLE % table)
+        return module
+
+    return [
+        _make_module(_MODULE_V1 + "_mod_one", "mod_one"),
+        _make_module(_MODULE_V2 + "_mod_two", "mod_two"),
+    ]
+
+
+def test_upgrade_with_modules(sqlite_test_path, module_migrations):
+    """assert migrations can be passed as modules instead of a dir"""
     db_url = sqlite_test_path
+    caribou.upgrade(db_url, module_migrations)
+    conn = sqlite3.connect(db_url, uri=True)
+    try:
+        tables = ["mod_one", "mod_two"]
+        assert _existing_tables(conn, tables) == set(tables)
+    finally:
+        conn.close()
+    assert caribou.get_version(db_url) == _MODULE_V2
 
-    conn = sqlite3.connect(db_url)
-    assert not _table_exists(conn, "games")
-    assert not _table_exists(conn, "players")
-    assert caribou.get_version(db_url) is None
-
-    # assert that the first migration has been run successfully
-    # and that subsequent runs have no effect
-
-    v1 = "20091112130101"
-    v2 = "20091112150200"
-    v3 = "20091112150205"
-
-    for _ in range(3):
-        caribou.upgrade(db_url, migrations_path, v1)
-        assert _table_exists(conn, "games")
-        assert _table_exists(conn, "players")
-        actual_version = caribou.get_version(db_url)
-        assert actual_version == v1, "%s != %s" % (actual_version, v1)
-        # make sure none of the other migrations run
-        assert not _table_exists(conn, "scores")
-
-    # run the 2nd migration
-    for _ in range(3):
-        caribou.upgrade(db_url, migrations_path, v2)
-        tables = ["games", "players", "scores"]
-        assert all((_table_exists(conn, t) for t in tables))
-        actual_version = caribou.get_version(db_url)
-        assert actual_version == v2, "%s != %s" % (actual_version, v2)
-
-    # downgrade the second migration
-    for _ in range(3):
-        caribou.downgrade(db_url, migrations_path, v1)
-        assert _table_exists(conn, "games")
-        assert _table_exists(conn, "players")
-        actual_version = caribou.get_version(db_url)
-        assert actual_version == v1, "%s != %s" % (actual_version, v1)
-        # make sure none of the other migrations run
-        assert not _table_exists(conn, "scores")
-
-    # upgrade all the way
-    for _ in range(3):
-        caribou.upgrade(db_url, migrations_path)
-        tables = ["games", "players", "scores", "jams"]
-        assert all((_table_exists(conn, t) for t in tables))
-        actual_version = caribou.get_version(db_url)
-        assert actual_version == v3, "%s != %s" % (actual_version, v3)
-
-    # downgrade all the way
-    for _ in range(3):
-        caribou.downgrade(db_url, migrations_path, "0")
-        tables = ["games", "players", "scores", "jams"]
-        assert all((not _table_exists(conn, t) for t in tables))
-        actual_version = caribou.get_version(db_url)
-        assert actual_version == "0"
-
-    # upgrade all the way again
-    for _ in range(3):
-        caribou.upgrade(db_url, migrations_path)
-        tables = ["games", "players", "scores", "jams"]
-        assert all((_table_exists(conn, t) for t in tables))
-        actual_version = caribou.get_version(db_url)
-        assert actual_version == v3, "%s != %s" % (actual_version, v3)
+
+def test_downgrade_with_modules(sqlite_test_path, module_migrations):
+    """assert module migrations can be rolled back"""
+    db_url = sqlite_test_path
+    caribou.upgrade(db_url, module_migrations)
+    caribou.downgrade(db_url, module_migrations, "0")
+    conn = sqlite3.connect(db_url, uri=True)
+    try:
+        assert not _existing_tables(conn, ["mod_one", "mod_two"])
+    finally:
+        conn.close()
+    assert caribou.get_version(db_url) == "0"
+
+
+def test_database_instance_reuse(sqlite_test_path, cached_migrations):
+    """assert one Database instance survives a full down/up cycle
+
+    the instance caches the db version, so the cached value must match
+    what the text-affinity version column would return on a re-read
+    """
+    db = caribou.migrate.Database(sqlite_test_path)
+    try:
+        db.initialize_version_control()
+        db.upgrade(cached_migrations)
+        assert db.get_version() == _V3
+        db.downgrade(cached_migrations, "0")
+        assert db.get_version() == "0"
+        db.upgrade(cached_migrations)
+        assert db.get_version() == _V3
+    finally:
+        db.close()
 
 
 def test_create_migration():
     """assert we can create migration templates"""
-    for name, directory in [("tc_1", None), ("tc_2", "test_create__")]:
-        if directory and not os.path.exists(directory):
-            os.makedirs(directory)
-        path = caribou.create_migration(name, directory)
-        try:
-            assert os.path.exists(path)
-        finally:
-            # remove compiled test migration as well
-            for path in [path, path + "c"]:
-                if os.path.exists(path):
-                    os.remove(path)
-            if directory and os.path.exists(directory):
-                shutil.rmtree(directory)
+    # in the working directory
+    path = caribou.create_migration("tc_1")
+    try:
+        assert os.path.exists(path)
+    finally:
+        # remove compiled test migration as well
+        for path in [path, path + "c"]:
+            _unlink(path)
+    # in a directory of the caller's choosing. TemporaryDirectory
+    # sweeps the migration and any compiled artifacts in one pass.
+    with tempfile.TemporaryDirectory() as directory:
+        path = caribou.create_migration("tc_2", directory)
+        assert os.path.exists(path)
     # assert we can't create migrations in a directoin that doesn't exist
     try:
         caribou.create_migration("adsf", "/path/to/nowhereski")